@@ -1,37 +1,102 @@
 import os
+import hashlib
+import shutil
+import sqlite3
+import tempfile
+import time
+import functools
+from types import SimpleNamespace
+from urllib.parse import quote_plus
+from concurrent.futures import ThreadPoolExecutor
+import click
 from flask import (
     Flask, render_template, request, redirect, url_for,
-    flash, session, send_from_directory, abort
+    flash, session, send_from_directory, abort, g,
+    stream_template, get_flashed_messages, make_response
 )
 from flask_sqlalchemy import SQLAlchemy
-from werkzeug.security import generate_password_hash, check_password_hash
+from flask_caching import Cache
+from jinja2 import FileSystemBytecodeCache
+from argon2 import PasswordHasher
+from argon2.exceptions import VerificationError, InvalidHashError
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+from sqlalchemy.orm import load_only
+from werkzeug.security import check_password_hash
 from werkzeug.utils import secure_filename
 
 # -------------------- App Config --------------------
 app = Flask(__name__)
-app.config['SECRET_KEY'] = 'change-this-secret'
+app.config['SECRET_KEY'] = os.environ.get('SECRET_KEY', 'change-this-secret')
+app.config['SESSION_COOKIE_SAMESITE'] = 'Lax'
 app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///database.db'
 app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+app.config['SQLALCHEMY_ENGINE_OPTIONS'] = {
+    'pool_size': 10, 'max_overflow': 20, 'pool_recycle': 1800, 'pool_pre_ping': True,
+    'connect_args': {'check_same_thread': False, 'timeout': 15},
+}
 app.config['UPLOAD_FOLDER'] = os.path.join('static', 'uploads')
 app.config['MAX_CONTENT_LENGTH'] = 8 * 1024 * 1024  # 8 MB
+# Let a fronting server (nginx/Apache) stream files via X-Sendfile when set
+app.config['USE_X_SENDFILE'] = os.environ.get('USE_X_SENDFILE') == '1'
 os.makedirs(app.config['UPLOAD_FOLDER'], exist_ok=True)
+# Outside static/ so deleted images aren't publicly served; must share a
+# filesystem with UPLOAD_FOLDER for os.replace()
+app.config['TRASH_FOLDER'] = os.path.join(app.instance_path, 'upload_trash')
+os.makedirs(app.config['TRASH_FOLDER'], exist_ok=True)
+ALLOWED_IMAGE_EXTENSIONS = {'.jpg', '.jpeg', '.png', '.webp', '.gif'}
 
 db = SQLAlchemy(app)
+# Compile templates once per deploy rather than once per worker start
+_jinja_cache_dir = os.path.join(app.instance_path, 'jinja_cache')
+os.makedirs(_jinja_cache_dir, exist_ok=True)
+app.jinja_env.bytecode_cache = FileSystemBytecodeCache(_jinja_cache_dir)
+# SimpleCache is per-process: the Procfile runs a single (threaded) worker so
+# cache.delete() reaches every request. Switch to RedisCache before adding workers.
+cache = Cache(app, config={'CACHE_TYPE': 'SimpleCache'})
+
+@event.listens_for(Engine, "connect")
+def _sqlite_pragmas(dbapi_con, _):
+    # WAL lets readers run alongside a writer; NORMAL sync is safe under WAL
+    if not isinstance(dbapi_con, sqlite3.Connection):
+        return
+    cur = dbapi_con.cursor()
+    cur.execute("PRAGMA journal_mode=WAL")
+    cur.execute("PRAGMA synchronous=NORMAL")
+    cur.execute("PRAGMA temp_store=MEMORY")
+    cur.execute("PRAGMA mmap_size=268435456")  # 256 MB
+    cur.execute("PRAGMA cache_size=-65536")     # 64 MB
+    cur.close()
+
+# Argon2id, OWASP minimum profile (19 MiB, t=2, p=1)
+ph = PasswordHasher(time_cost=2, memory_cost=19456, parallelism=1)
+# argon2-cffi releases the GIL, so hashes from concurrent requests overlap here
+HASH_POOL = ThreadPoolExecutor(max_workers=os.cpu_count() or 1)
 
 # -------------------- Models --------------------
 class User(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     name = db.Column(db.String(120), nullable=False)
-    email = db.Column(db.String(120), unique=True, nullable=False)
+    email = db.Column(db.String(120), unique=True, nullable=False)  # stored lowercased
     password_hash = db.Column(db.String(255), nullable=False)
     role = db.Column(db.String(20), default='owner')  # 'owner' or 'customer'
-    properties = db.relationship('Property', backref='owner', lazy=True)
+    properties = db.relationship('Property', back_populates='owner', lazy='raise')
 
     def set_password(self, password):
-        self.password_hash = generate_password_hash(password)
+        self.password_hash = HASH_POOL.submit(ph.hash, password).result()
 
     def check_password(self, password):
-        return check_password_hash(self.password_hash, password)
+        if not self.password_hash.startswith('$argon2'):
+            # legacy Werkzeug hash (scrypt/pbkdf2), upgraded on next login
+            return HASH_POOL.submit(check_password_hash, self.password_hash, password).result()
+        try:
+            return HASH_POOL.submit(ph.verify, self.password_hash, password).result()
+        except (VerificationError, InvalidHashError):
+            return False
+
+    def needs_rehash(self):
+        return (not self.password_hash.startswith('$argon2')
+                or ph.check_needs_rehash(self.password_hash))
 
 
 class Property(db.Model):
@@ -39,21 +104,48 @@ class Property(db.Model):
     title = db.Column(db.String(200), nullable=False)
     description = db.Column(db.Text)
     location = db.Column(db.String(200), nullable=False)
-    property_type = db.Column(db.String(20), nullable=False)  # 'land' or 'house'
-    sale_or_rent = db.Column(db.String(10), nullable=False)   # 'sale' or 'rent'
-    price = db.Column(db.Float)   # for sale
-    rent = db.Column(db.Float)    # for rent
-    area = db.Column(db.Float)    # sq.ft or acres
-    rooms = db.Column(db.Integer) # houses only
+    location_lower = db.Column(db.String(200), index=True)  # kept in sync by _sync_location_lower
+    property_type = db.Column(db.String(20), nullable=False)  # 'land' or 'house'; led by the composites below
+    sale_or_rent = db.Column(db.String(10), nullable=False, index=True)   # 'sale' or 'rent'
+    price = db.Column(db.Float, index=True)   # for sale
+    rent = db.Column(db.Float, index=True)    # for rent
+    area = db.Column(db.Float, index=True)    # sq.ft or acres
+    rooms = db.Column(db.Integer, index=True) # houses only
     contact = db.Column(db.String(120))
     image_filename = db.Column(db.String(255))
     gmap_link = db.Column(db.String(500))  # optional direct Google Maps link
-    owner_id = db.Column(db.Integer, db.ForeignKey('user.id'))
+    owner_id = db.Column(db.Integer, db.ForeignKey('user.id'), index=True)
+    owner = db.relationship('User', back_populates='properties', lazy='select')
+
+    # type + mode are almost always filtered together on /properties
+    __table_args__ = (
+        db.Index('ix_prop_type_mode', 'property_type', 'sale_or_rent'),
+        db.Index('ix_prop_type_price', 'property_type', 'price'),
+        db.Index('ix_prop_type_id', 'property_type', 'id'),  # paged listing order
+    )
+
+    @db.validates('location')
+    def _sync_location_lower(self, key, value):
+        self.location_lower = value.lower() if value else value
+        return value
 
 # -------------------- Helpers --------------------
+def remember_user(u):
+    # Signed session cookie carries what pages need, so no per-request lookup
+    session['user_id'] = u.id
+    session['user'] = {'id': u.id, 'name': u.name, 'role': u.role}
+
 def current_user():
-    uid = session.get('user_id')
-    return User.query.get(uid) if uid else None
+    # Memoised on `g`; only sessions from before the cookie held the user hit the DB
+    if 'user' not in g:
+        data = session.get('user')
+        if data is None and session.get('user_id'):
+            u = db.session.get(User, session['user_id'])
+            if u:
+                remember_user(u)
+                data = session['user']
+        g.user = SimpleNamespace(**data) if data else None
+    return g.user
 
 def login_required():
     if not current_user():
@@ -64,27 +156,74 @@ def login_required():
 def save_image(file_storage):
     if not file_storage or file_storage.filename.strip() == "":
         return None
-    filename = secure_filename(file_storage.filename)
-    base, ext = os.path.splitext(filename)
+    ext = os.path.splitext(secure_filename(file_storage.filename))[1].lower()
+    if ext not in ALLOWED_IMAGE_EXTENSIONS:
+        flash('Unsupported image type; use JPG, PNG, WEBP or GIF.', 'warning')
+        return None
+    # Content-addressed name: no collision probing, identical uploads share a file
+    stream = file_storage.stream
+    stream.seek(0)
+    h = hashlib.sha256()
+    for chunk in iter(lambda: stream.read(64 * 1024), b''):
+        h.update(chunk)
+    filename = f"{h.hexdigest()}{ext}"
     path = os.path.join(app.config['UPLOAD_FOLDER'], filename)
-    i = 1
-    while os.path.exists(path):
-        filename = f"{base}_{i}{ext}"
-        path = os.path.join(app.config['UPLOAD_FOLDER'], filename)
-        i += 1
-    file_storage.save(path)
+    # A just-deleted listing may have trashed this exact file; take it back
+    if not os.path.exists(path) and not restore_image(filename):
+        stream.seek(0)
+        # Per-writer temp file: identical uploads may be saved concurrently
+        fd, tmp_path = tempfile.mkstemp(dir=app.config['UPLOAD_FOLDER'], suffix='.part')
+        try:
+            os.chmod(fd, 0o644)  # mkstemp creates 0600; keep uploads web-readable
+            with open(fd, 'wb', buffering=0) as dst:
+                shutil.copyfileobj(stream, dst, length=1 << 20)  # 1 MiB writes
+            os.replace(tmp_path, path)
+        except BaseException:
+            try:
+                os.remove(tmp_path)
+            except OSError:
+                pass
+            raise
     return filename
 
+def restore_image(filename):
+    # Move a trashed image back into uploads; False if it wasn't in the trash
+    try:
+        os.replace(os.path.join(app.config['TRASH_FOLDER'], filename),
+                   os.path.join(app.config['UPLOAD_FOLDER'], filename))
+    except OSError:
+        return False
+    return True
+
+def listing_options():
+    # Only the columns the listing cards render; description etc. stay deferred
+    return (
+        load_only(Property.id, Property.title, Property.location, Property.price,
+                  Property.rent, Property.image_filename, Property.property_type,
+                  Property.sale_or_rent),
+    )
+
+@cache.cached(timeout=30, key_prefix='home_latest')
+def latest_properties():
+    # Plain dicts (not ORM rows) so cached entries outlive the session
+    rows = (Property.query.options(*listing_options())
+            .order_by(Property.id.desc()).limit(6).all())
+    return [
+        dict(id=p.id, title=p.title, location=p.location,
+             sale_or_rent=p.sale_or_rent, price=p.price, rent=p.rent,
+             image_filename=p.image_filename)
+        for p in rows
+    ]
+
+@functools.lru_cache(maxsize=2048)
 def build_gmaps_link(location):
     # Safe default link if user didn't paste a direct Google Maps URL
-    from urllib.parse import quote_plus
     return f"https://www.google.com/maps/search/?api=1&query={quote_plus(location)}"
 
 # -------------------- Routes: Public --------------------
 @app.route('/')
 def index():
-    latest = Property.query.order_by(Property.id.desc()).limit(6).all()
-    return render_template('index.html', properties=latest, user=current_user())
+    return render_template('index.html', properties=latest_properties(), user=current_user())
 
 @app.route('/properties')
 def properties():
@@ -99,9 +238,9 @@ def properties():
     q_max_area = request.args.get('max_area', type=float)
     q_rooms = request.args.get('rooms', type=int)
 
-    query = Property.query
+    query = Property.query.options(*listing_options())
     if q_location:
-        query = query.filter(Property.location.ilike(f"%{q_location}%"))
+        query = query.filter(Property.location_lower.like(f"%{q_location.lower()}%"))
     if q_type:
         query = query.filter(Property.property_type == q_type)
     if q_mode:
@@ -121,17 +260,45 @@ def properties():
     if q_rooms is not None:
         query = query.filter(Property.rooms == q_rooms)
 
-    results = query.order_by(Property.id.desc()).all()
-    return render_template('properties.html', properties=results, user=current_user())
+    page = request.args.get('page', 1, type=int)
+    pagination = query.order_by(Property.id.desc()).paginate(
+        page=page, per_page=24, error_out=False
+    )
+    # Pop flashes now: the session cookie is written before a streamed body runs
+    get_flashed_messages(with_categories=True)
+    return stream_template('properties.html', properties=pagination.items,
+                           pagination=pagination, user=current_user())
 
 @app.route('/property/<int:pid>')
 def property_detail(pid):
-    p = Property.query.get_or_404(pid)
-    return render_template('property_detail.html', property=p, user=current_user())
+    p = db.session.get(Property, pid) or abort(404)
+    user = current_user()
+    # Fingerprint everything the page shows, incl. the viewer (owner actions/navbar).
+    # hashlib rather than hash(): str hashes differ between worker processes.
+    fingerprint = (p.title, p.description, p.location, p.property_type, p.sale_or_rent,
+                   p.price, p.rent, p.area, p.rooms, p.contact, p.image_filename,
+                   p.gmap_link, p.owner_id, user and (user.id, user.name))
+    etag = f"{p.id}-{hashlib.sha1(repr(fingerprint).encode()).hexdigest()[:16]}"
+    # Pending flashes must be rendered, so never short-circuit them
+    if '_flashes' not in session and request.if_none_match.contains_weak(etag):
+        resp = make_response('', 304)
+    else:
+        resp = make_response(render_template('property_detail.html', property=p, user=user))
+    resp.set_etag(etag, weak=True)
+    resp.cache_control.private = True
+    resp.cache_control.max_age = 60
+    resp.vary.add('Cookie')
+    return resp
 
 @app.route('/uploads/<path:filename>')
 def uploaded_file(filename):
-    return send_from_directory(app.config['UPLOAD_FOLDER'], filename)
+    # Upload names are content hashes, so browsers can cache them for good;
+    # ideally the web server serves /uploads/ itself and this is never hit
+    resp = send_from_directory(app.config['UPLOAD_FOLDER'], filename,
+                               conditional=True, max_age=7 * 24 * 3600)
+    resp.cache_control.public = True
+    resp.cache_control.immutable = True
+    return resp
 
 # -------------------- Routes: Auth --------------------
 @app.route('/register', methods=['GET', 'POST'])
@@ -144,7 +311,7 @@ def register():
         if not name or not email or not password:
             flash('All fields are required.', 'danger')
             return redirect(url_for('register'))
-        if User.query.filter_by(email=email).first():
+        if db.session.scalar(db.select(User.id).where(User.email == email)):
             flash('Email already registered.', 'warning')
             return redirect(url_for('register'))
         u = User(name=name, email=email, role=role)
@@ -160,11 +327,18 @@ def login():
     if request.method == 'POST':
         email = request.form['email'].strip().lower()
         password = request.form['password']
-        u = User.query.filter_by(email=email).first()
+        u = db.session.scalar(
+            db.select(User)
+            .where(User.email == email)
+            .options(load_only(User.id, User.name, User.role, User.password_hash))
+        )
         if not u or not u.check_password(password):
             flash('Invalid email or password.', 'danger')
             return redirect(url_for('login'))
-        session['user_id'] = u.id
+        if u.needs_rehash():
+            u.set_password(password)
+            db.session.commit()
+        remember_user(u)
         flash('Logged in.', 'success')
         return redirect(url_for('index'))
     return render_template('login.html', user=current_user())
@@ -207,6 +381,9 @@ def add_property():
         )
         db.session.add(p)
         db.session.commit()
+        if image_filename:
+            restore_image(image_filename)  # a delete may have trashed it since save_image
+        cache.delete('home_latest')
         flash('Property added!', 'success')
         return redirect(url_for('properties'))
     return render_template('add_property.html', user=current_user())
@@ -215,7 +392,7 @@ def add_property():
 def edit_property(pid):
     if not login_required():
         return redirect(url_for('login'))
-    p = Property.query.get_or_404(pid)
+    p = db.session.get(Property, pid) or abort(404)
     # Only owner can edit
     if p.owner_id != current_user().id:
         abort(403)
@@ -235,9 +412,12 @@ def edit_property(pid):
 
         img = request.files.get('image')
         if img and img.filename.strip():
-            p.image_filename = save_image(img)
+            p.image_filename = save_image(img) or p.image_filename
 
         db.session.commit()
+        if p.image_filename:
+            restore_image(p.image_filename)  # a delete may have trashed it since save_image
+        cache.delete('home_latest')
         flash('Property updated!', 'success')
         return redirect(url_for('property_detail', pid=p.id))
     return render_template('edit_property.html', property=p, user=current_user())
@@ -246,24 +426,86 @@ def edit_property(pid):
 def delete_property(pid):
     if not login_required():
         return redirect(url_for('login'))
-    p = Property.query.get_or_404(pid)
+    # Owner check + image cleanup only; skip the description/Text columns
+    p = db.session.get(Property, pid, options=[
+        load_only(Property.id, Property.owner_id, Property.image_filename)
+    ]) or abort(404)
     if p.owner_id != current_user().id:
         abort(403)
-    # delete image file if exists
-    if p.image_filename:
+    orig = p.image_filename
+    # Check for other listings sharing the image inside the same transaction,
+    # so the whole delete costs a single commit
+    shared = orig and db.session.scalar(
+        db.select(Property.id)
+        .where(Property.image_filename == orig, Property.id != p.id)
+    )
+    db.session.delete(p)
+    db.session.commit()
+    cache.delete('home_latest')
+    # Row is gone; park the image in the trash (O(1) rename) unless another
+    # listing shares it. `flask sweep-trash` does the actual unlinking.
+    if orig and not shared:
+        trashed = os.path.join(app.config['TRASH_FOLDER'], orig)
         try:
-            os.remove(os.path.join(app.config['UPLOAD_FOLDER'], p.image_filename))
+            os.replace(os.path.join(app.config['UPLOAD_FOLDER'], orig), trashed)
+            os.utime(trashed)  # sweeper ages files from when they were trashed
         except OSError:
             pass
-    db.session.delete(p)
-    db.session.commit()
+        else:
+            # Pairs with the post-commit restore in add/edit: whichever side
+            # runs second sees the other's change and puts the file back
+            if image_in_use(orig):
+                restore_image(orig)
     flash('Property deleted.', 'danger')
     return redirect(url_for('properties'))
 
+# -------------------- Maintenance --------------------
+def image_in_use(filename):
+    return db.session.scalar(
+        db.select(Property.id).where(Property.image_filename == filename)
+    ) is not None
+
+@app.cli.command('sweep-trash')
+@click.option('--max-age', default=60, show_default=True,
+              help='Delete trashed images older than this many minutes.')
+def sweep_trash(max_age):
+    """Unlink images moved to the upload trash by delete_property()."""
+    cutoff = time.time() - max_age * 60
+    removed = 0
+    with os.scandir(app.config['TRASH_FOLDER']) as entries:
+        for entry in entries:
+            try:
+                if entry.is_file() and entry.stat().st_mtime < cutoff:
+                    os.remove(entry.path)
+                    removed += 1
+            except OSError:
+                pass
+    click.echo(f'Removed {removed} trashed image(s).')
+
 # -------------------- Init DB & Run --------------------
+def _upgrade_schema():
+    # create_all() won't add columns to an existing table; backfill by hand
+    cols = {c['name'] for c in db.inspect(db.engine).get_columns('property')}
+    if 'location_lower' not in cols:
+        with db.engine.begin() as conn:
+            conn.execute(db.text("ALTER TABLE property ADD COLUMN location_lower VARCHAR(200)"))
+    # Backfill through the validator: SQLite's lower() only folds ASCII
+    rows = Property.query.options(
+        load_only(Property.id, Property.location, Property.location_lower)
+    ).all()
+    for p in rows:
+        if p.location and p.location_lower != p.location.lower():
+            p.location = p.location
+    db.session.commit()
+    # create_all() skips indexes on existing tables too
+    for table in (User.__table__, Property.__table__):
+        for idx in table.indexes:
+            idx.create(db.engine, checkfirst=True)
+
 def init_db():
     with app.app_context():
         db.create_all()
+        _upgrade_schema()
         if not User.query.first():
             demo = User(name='Demo Owner', email='owner@example.com', role='owner')
             demo.set_password('demo123')
@@ -271,5 +513,7 @@ def init_db():
             db.session.commit()
 
 if __name__ == "__main__":
-    app.run(debug=True, use_reloader=False, port=5000)
+    # Local development only; production runs gunicorn against wsgi:app
+    init_db()
+    app.run(debug=os.environ.get('FLASK_DEBUG') == '1', use_reloader=False, port=5000)
 
@@ -0,0 +1,4 @@
+# WSGI entry point: gunicorn -k gthread -w 1 --threads 8 wsgi:app
+from app import app
+
+__all__ = ['app']